@@ -0,0 +1,19 @@
+"""
+Redis client management.
+Shared state (poll tokens, cached stats) lives here so every worker sees it.
+"""
+from functools import lru_cache
+
+from redis.asyncio import Redis
+
+from config import get_settings
+
+
+POLL_TOKEN_KEY = "tok:{poll_token}"
+STATS_KEY = "stats:{poll_id}"
+
+
+@lru_cache
+def get_redis() -> Redis:
+    """Create the Redis client on first use; connections are opened lazily."""
+    return Redis.from_url(get_settings().REDIS_URL, decode_responses=True)
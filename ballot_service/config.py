@@ -3,7 +3,8 @@ Configuration management for the Ballot Validation Service.
 Load settings from environment variables with sensible defaults.
 """
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from typing import List
+from functools import cached_property, lru_cache
+from typing import FrozenSet, List
 import os
 
 
@@ -20,27 +21,56 @@ class Settings(BaseSettings):
     SALT_KEY: str = "CHANGE_ME_IN_PRODUCTION_abc123xyz"
     
     # Database
-    DATABASE_URL: str = "sqlite:///./ballot_votes.db"
+    DATABASE_URL: str = "sqlite+aiosqlite:///./ballot_votes.db"
+    # Connection pool (ignored for SQLite)
+    DB_POOL_SIZE: int = 20  # Connections opened (and pre-warmed) per process
+    DB_MAX_OVERFLOW: int = 20  # Extra connections allowed under burst load
+    DB_POOL_TIMEOUT: int = 10  # Seconds to wait for a connection before failing with 503
+    DB_POOL_RECYCLE: int = 1800  # Seconds before a connection is replaced
+    DB_POOL_PRE_PING: bool = True  # Test connections on checkout
+    STARTUP_RETRIES: int = 5  # Attempts at init_db/warm_pool before giving up
+    STARTUP_RETRY_DELAY: float = 1.0  # Seconds before the first retry; doubles each time
+    
+    # Redis (poll tokens, cached stats)
+    REDIS_URL: str = "redis://localhost:6379/0"
+    POLL_TOKEN_TTL_SECONDS: int = 86400  # Tokens expire after 24 hours
+    STATS_CACHE_TTL_SECONDS: int = 15  # How long /stats results are served from cache
     
     # Allowed government signers for PAdES validation
     # These are the CN (Common Name) values from the signing certificates
+    # Matching is case-insensitive, so list each name once
     ALLOWED_SIGNERS: List[str] = [
         "Hellenic Republic",
-        "HELLENIC REPUBLIC", 
         "Ministry of Digital Governance",
-        "MINISTRY OF DIGITAL GOVERNANCE",
         "Ελληνική Δημοκρατία",
         "Υπουργείο Ψηφιακής Διακυβέρνησης",
         "APOSTILLE",  # Gov.gr signing service
     ]
     
+    # Threads used for blocking PDF parsing / signature verification
+    PDF_WORKERS: int = os.cpu_count() or 1
+    
     # Application settings
     DEBUG: bool = False
     API_PREFIX: str = "/api/ballot"
     
     # Vote update policy
     ALLOW_VOTE_UPDATE: bool = False
+    
+    @cached_property
+    def allowed_signers_set(self) -> FrozenSet[str]:
+        """Case-folded ALLOWED_SIGNERS for case-insensitive matching."""
+        return frozenset(s.casefold() for s in self.ALLOWED_SIGNERS)
+
+
+@lru_cache
+def get_settings() -> Settings:
+    """Return the cached settings instance, built on first access."""
+    return Settings()
 
 
-# Singleton settings instance
-settings = Settings()
+def __getattr__(name: str):
+    # Backwards compatibility for `from config import settings`
+    if name == "settings":
+        return get_settings()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,60 +1,104 @@
 """
 Database connection and session management.
 """
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from contextlib import contextmanager
-from typing import Generator
+import asyncio
 
-from config import settings
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import AsyncGenerator
+
+from config import get_settings
 from models import Base
 
 
-# Create engine based on configuration
-# For SQLite, we need check_same_thread=False for FastAPI async compatibility
-connect_args = {}
-if settings.DATABASE_URL.startswith("sqlite"):
-    connect_args["check_same_thread"] = False
+@lru_cache
+def get_engine() -> AsyncEngine:
+    """
+    Create the async engine on first use.
+    Expects an async driver URL, e.g. sqlite+aiosqlite:// or postgresql+asyncpg://
+    """
+    settings = get_settings()
+
+    # SQLite keeps SQLAlchemy's default pool; server databases get explicit sizing
+    engine_kwargs = {}
+    if not settings.DATABASE_URL.startswith("sqlite"):
+        engine_kwargs.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            pool_pre_ping=settings.DB_POOL_PRE_PING,
+        )
+
+    return create_async_engine(
+        settings.DATABASE_URL,
+        echo=settings.DEBUG,
+        **engine_kwargs,
+    )
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    connect_args=connect_args,
-    echo=settings.DEBUG,
-)
 
-# Session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@lru_cache
+def get_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    """Session factory bound to the shared engine."""
+    return async_sessionmaker(
+        get_engine(),
+        class_=AsyncSession,
+        autoflush=False,
+        expire_on_commit=False,
+    )
 
 
-def init_db() -> None:
+async def init_db() -> None:
     """Initialize the database by creating all tables."""
-    Base.metadata.create_all(bind=engine)
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
 
-def get_db() -> Generator[Session, None, None]:
+async def warm_pool() -> None:
+    """
+    Open DB_POOL_SIZE connections up front so the first requests
+    don't pay connection-establishment latency.
+    Skipped for SQLite, which keeps the default pool (see get_engine).
+    """
+    settings = get_settings()
+    if settings.DATABASE_URL.startswith("sqlite"):
+        return
+
+    engine = get_engine()
+
+    async def _ping() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(_ping() for _ in range(settings.DB_POOL_SIZE)))
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
     Dependency that provides a database session.
     Used with FastAPI's Depends() for request-scoped sessions.
     """
-    db = SessionLocal()
-    try:
+    async with get_sessionmaker()() as db:
         yield db
-    finally:
-        db.close()
 
 
-@contextmanager
-def get_db_context() -> Generator[Session, None, None]:
+@asynccontextmanager
+async def get_db_context() -> AsyncGenerator[AsyncSession, None]:
     """
     Context manager for database sessions.
     Use when not in a FastAPI request context.
     """
-    db = SessionLocal()
-    try:
-        yield db
-        db.commit()
-    except Exception:
-        db.rollback()
-        raise
-    finally:
-        db.close()
+    async with get_sessionmaker()() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
@@ -6,21 +6,85 @@ Provides REST API endpoints for:
 - Frontend instructions
 - Health checks
 """
-import nest_asyncio
-nest_asyncio.apply()
+import asyncio
+import importlib
+import logging
+import sys
+from contextlib import asynccontextmanager, suppress
 
-from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
 
-from sqlalchemy.orm import Session
+import orjson
+from redis.exceptions import RedisError
 
-from config import settings
-from database import get_db, init_db
-from validator import BallotValidator, ValidationResult, RejectionReason
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import POLL_TOKEN_KEY, STATS_KEY, get_redis
+from config import get_settings
+from database import get_db, get_engine, init_db, warm_pool
+
+
+logger = logging.getLogger(__name__)
+
+# Set once deferred startup work has finished; gates /health/ready
+READY = False
+# Set if deferred startup failed; reported by /health/ready
+INIT_ERROR: Optional[str] = None
+
+
+async def _deferred_init() -> None:
+    """
+    Create tables, warm the pool and preload the validator off the bind path.
+    Retries with exponential backoff so a database that is still coming up
+    doesn't fail the process for good.
+    """
+    global READY, INIT_ERROR
+    settings = get_settings()
+    delay = settings.STARTUP_RETRY_DELAY
+    for attempt in range(1, settings.STARTUP_RETRIES + 1):
+        try:
+            await init_db()
+            await warm_pool()
+            # Preload the PDF/signature stack so the first upload doesn't pay for it
+            await asyncio.to_thread(importlib.import_module, "validator")
+            break
+        except Exception as e:
+            if attempt == settings.STARTUP_RETRIES:
+                logger.exception("Deferred startup failed after %d attempts", attempt)
+                # Only the exception type is exposed; details stay in the logs
+                INIT_ERROR = type(e).__name__
+                return
+            logger.warning(
+                "Deferred startup attempt %d/%d failed (%s), retrying in %.1fs",
+                attempt, settings.STARTUP_RETRIES, type(e).__name__, delay,
+            )
+            await asyncio.sleep(delay)
+            delay *= 2
+    READY = True
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start heavy initialisation in the background so the port binds immediately."""
+    init_task = asyncio.create_task(_deferred_init())
+    yield
+    init_task.cancel()
+    # Let a still-running warm-up release its connections before disposing
+    with suppress(asyncio.CancelledError):
+        await init_task
+    await get_engine().dispose()
+    await get_redis().aclose()
+    # Only loaded once deferred startup or a request has imported the validator
+    validator = sys.modules.get("validator")
+    if validator is not None:
+        validator.shutdown_pdf_executor()
 
 
 # Initialize FastAPI app
@@ -28,8 +92,12 @@ app = FastAPI(
     title="Gov.gr Ballot Box API",
     description="Secure voting system using government-issued Solemn Declarations",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
+# Route prefix is needed at import time to register the endpoints
+API_PREFIX = get_settings().API_PREFIX
+
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -72,17 +140,50 @@ class PollTokenResponse(BaseModel):
     expires_at: str
 
 
-# Store active poll tokens (in production, use Redis or database)
-active_poll_tokens: dict[str, dict] = {}
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+
+
+async def read_pdf_upload(file: UploadFile) -> bytes:
+    """
+    Read an upload into a single buffer, enforcing the 10MB limit.
+    
+    Starlette has already spooled the body, so an oversized upload is
+    rejected from its recorded size before any bytes are read.
+    """
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail="File size exceeds 10MB limit"
+        )
+    
+    try:
+        pdf_bytes = await file.read()
+    except Exception as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Failed to read uploaded file: {str(e)}"
+        )
+    
+    # Size may be unknown up front (e.g. no Content-Length on the part)
+    if len(pdf_bytes) > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail="File size exceeds 10MB limit"
+        )
+    
+    return pdf_bytes
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize database on startup."""
-    init_db()
+@app.exception_handler(PoolTimeoutError)
+async def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    """Fail fast with 503 when no database connection is available."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Service temporarily overloaded, please retry"}
+    )
 
 
-@app.get(f"{settings.API_PREFIX}/health", response_model=HealthResponse)
+@app.get(f"{API_PREFIX}/health", response_model=HealthResponse)
 async def health_check():
     """
     Health check endpoint.
@@ -96,7 +197,43 @@ async def health_check():
     )
 
 
-@app.post(f"{settings.API_PREFIX}/token", response_model=PollTokenResponse)
+@app.get(f"{API_PREFIX}/health/live", response_model=HealthResponse)
+async def health_live():
+    """
+    Liveness probe.
+    
+    Succeeds while the process is serving requests, and fails once deferred
+    startup has given up so the orchestrator restarts the process.
+    """
+    if INIT_ERROR:
+        raise HTTPException(status_code=503, detail=f"Startup failed ({INIT_ERROR}), see logs")
+    return HealthResponse(
+        status="alive",
+        timestamp=datetime.utcnow().isoformat(),
+        version="1.0.0"
+    )
+
+
+@app.get(f"{API_PREFIX}/health/ready", response_model=HealthResponse)
+async def health_ready():
+    """
+    Readiness probe.
+    
+    Returns 503 until deferred startup (database, pool warm-up) has finished,
+    or with the error if it failed.
+    """
+    if INIT_ERROR:
+        raise HTTPException(status_code=503, detail=f"Startup failed ({INIT_ERROR}), see logs")
+    if not READY:
+        raise HTTPException(status_code=503, detail="Service is starting up")
+    return HealthResponse(
+        status="ready",
+        timestamp=datetime.utcnow().isoformat(),
+        version="1.0.0"
+    )
+
+
+@app.post(f"{API_PREFIX}/token", response_model=PollTokenResponse)
 async def generate_poll_token(request: PollTokenRequest):
     """
     Generate a unique token for a poll session.
@@ -105,13 +242,15 @@ async def generate_poll_token(request: PollTokenRequest):
     The token must be included in the Solemn Declaration text.
     """
     poll_token = str(uuid.uuid4())
-    expires_at = datetime.utcnow()  # Add 24 hours in production
+    ttl = get_settings().POLL_TOKEN_TTL_SECONDS
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
     
-    # Store token (in production, use Redis with TTL)
-    active_poll_tokens[poll_token] = {
-        "poll_id": request.poll_id,
-        "created_at": datetime.utcnow().isoformat(),
-    }
+    # Store token in Redis; the TTL evicts it automatically
+    await get_redis().set(
+        POLL_TOKEN_KEY.format(poll_token=poll_token),
+        request.poll_id,
+        ex=ttl,
+    )
     
     return PollTokenResponse(
         poll_id=request.poll_id,
@@ -120,7 +259,7 @@ async def generate_poll_token(request: PollTokenRequest):
     )
 
 
-@app.get(f"{settings.API_PREFIX}/instructions", response_model=InstructionsResponse)
+@app.get(f"{API_PREFIX}/instructions", response_model=InstructionsResponse)
 async def get_instructions(poll_id: str, poll_token: str):
     """
     Get voting instructions for the frontend.
@@ -143,12 +282,12 @@ async def get_instructions(poll_id: str, poll_token: str):
     )
 
 
-@app.post(f"{settings.API_PREFIX}/validate", response_model=ValidationResponse)
+@app.post(f"{API_PREFIX}/validate", response_model=ValidationResponse)
 async def validate_ballot(
     file: UploadFile = File(..., description="Gov.gr Solemn Declaration PDF"),
     poll_id: str = Form(..., description="Poll identifier"),
     poll_token: str = Form(..., description="Session security token"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Validate an uploaded Gov.gr Solemn Declaration PDF.
@@ -174,22 +313,21 @@ async def validate_ballot(
             detail="File must be a PDF document"
         )
     
-    # Read file bytes
-    try:
-        pdf_bytes = await file.read()
-    except Exception as e:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Failed to read uploaded file: {str(e)}"
-        )
+    # Read file bytes (validator hashes the whole buffer in one call)
+    pdf_bytes = await read_pdf_upload(file)
     
-    # Validate file size (max 10MB)
-    max_size = 10 * 1024 * 1024  # 10MB
-    if len(pdf_bytes) > max_size:
-        raise HTTPException(
-            status_code=400,
-            detail="File size exceeds 10MB limit"
+    # Imported here so the PDF/signature stack isn't loaded at startup
+    from validator import BallotValidator, RejectionReason
+    
+    # Token must have been issued by /token for this poll and not expired
+    token_poll_id = await get_redis().get(POLL_TOKEN_KEY.format(poll_token=poll_token))
+    if token_poll_id != poll_id:
+        response = ValidationResponse(
+            success=False,
+            message="Poll token is unknown or has expired. Please request a new token.",
+            rejection_reason=RejectionReason.INVALID_TOKEN.value
         )
+        raise HTTPException(status_code=400, detail=response.model_dump())
     
     # Run validation
     validator = BallotValidator(db)
@@ -223,13 +361,20 @@ async def validate_ballot(
             # Bad request - wrong token, AFM not found, etc.
             raise HTTPException(status_code=400, detail=response.model_dump())
     
+    # New vote recorded - drop the cached tally for this poll. The vote is
+    # already committed, so a Redis failure only leaves the tally stale until the TTL
+    try:
+        await get_redis().delete(STATS_KEY.format(poll_id=poll_id))
+    except RedisError:
+        logger.warning("Could not invalidate cached stats for %s", poll_id, exc_info=True)
+    
     return response
     
     
-@app.post(f"{settings.API_PREFIX}/verify-identity", response_model=ValidationResponse)
+@app.post(f"{API_PREFIX}/verify-identity", response_model=ValidationResponse)
 async def verify_identity(
     file: UploadFile = File(..., description="Gov.gr Solemn Declaration PDF"),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Verify user identity from Gov.gr PDF (One-Time Verification).
@@ -245,12 +390,11 @@ async def verify_identity(
     if not file.filename or not file.filename.lower().endswith('.pdf'):
         raise HTTPException(status_code=400, detail="File must be a PDF document")
         
-    # Read bytes
-    try:
-        pdf_bytes = await file.read()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Failed to read file: {str(e)}")
+    # Read bytes (same single-read helper and 10MB limit as /validate)
+    pdf_bytes = await read_pdf_upload(file)
         
+    from validator import BallotValidator
+    
     # Run validation
     validator = BallotValidator(db)
     result = await validator.validate_identity(pdf_bytes)
@@ -260,40 +404,59 @@ async def verify_identity(
         message=result.message,
         rejection_reason=result.rejection_reason.value if result.rejection_reason else None,
         signer_name=result.signer_name,
-        voter_hash=result.voter_hash
+        voter_hash=result.voter_hash.hex() if result.voter_hash else None
     )
     
     if not result.success:
          raise HTTPException(status_code=400, detail=response.model_dump())
          
     return response
-@app.get(f"{settings.API_PREFIX}/stats")
-async def get_poll_stats(poll_id: str, db: Session = Depends(get_db)):
+@app.get(f"{API_PREFIX}/stats")
+async def get_poll_stats(poll_id: str, db: AsyncSession = Depends(get_db)):
     """
     Get voting statistics for a poll.
     
     Returns vote counts per choice (without revealing voter identities).
+    Results are cached in Redis for STATS_CACHE_TTL_SECONDS and invalidated
+    whenever a vote is recorded. If Redis is unavailable the database is queried directly.
     """
-    from sqlalchemy import func
+    redis = get_redis()
+    cache_key = STATS_KEY.format(poll_id=poll_id)
+    try:
+        cached = await redis.get(cache_key)
+    except RedisError:
+        logger.warning("Stats cache read failed for %s", poll_id, exc_info=True)
+        cached = None
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+    
+    from sqlalchemy import func, select
     from models import Vote
     
-    results = db.query(
+    query = select(
         Vote.vote_choice,
         func.count(Vote.id).label('count')
-    ).filter(
+    ).where(
         Vote.poll_id == poll_id
     ).group_by(
         Vote.vote_choice
-    ).all()
+    )
+    results = (await db.execute(query)).all()
     
     total_votes = sum(r.count for r in results)
     choices = {r.vote_choice: r.count for r in results}
     
-    return {
+    payload = orjson.dumps({
         "poll_id": poll_id,
         "total_votes": total_votes,
         "choices": choices
-    }
+    })
+    try:
+        await redis.set(cache_key, payload, ex=get_settings().STATS_CACHE_TTL_SECONDS)
+    except RedisError:
+        logger.warning("Stats cache write failed for %s", poll_id, exc_info=True)
+    
+    return Response(content=payload, media_type="application/json")
 
 
 if __name__ == "__main__":
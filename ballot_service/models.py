@@ -2,7 +2,7 @@
 Database models for the Ballot Validation Service.
 SQLAlchemy ORM models for storing votes.
 """
-from sqlalchemy import Column, String, Integer, DateTime, Index, func
+from sqlalchemy import Column, String, Integer, DateTime, LargeBinary, UniqueConstraint, func
 from sqlalchemy.orm import declarative_base
 from datetime import datetime
 
@@ -16,8 +16,8 @@ class Vote(Base):
     Attributes:
         id: Primary key
         poll_id: Identifier for the poll/election (e.g., "election_2024")
-        voter_hash: SHA256(AFM + SALT) - hashed voter identity, never raw AFM
-        file_hash: SHA256 of the entire PDF file bytes (unique constraint)
+        voter_hash: SHA256(AFM + SALT) raw digest - hashed voter identity, never raw AFM
+        file_hash: SHA256 raw digest of the entire PDF file bytes (unique constraint)
         vote_choice: The extracted vote option from the declaration text
         created_at: Timestamp when the vote was recorded
     """
@@ -25,14 +25,15 @@ class Vote(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     poll_id = Column(String(255), nullable=False, index=True)
-    voter_hash = Column(String(64), nullable=False, index=True)  # SHA256 = 64 hex chars
-    file_hash = Column(String(64), nullable=False, unique=True)  # SHA256 = 64 hex chars
+    voter_hash = Column(LargeBinary(32), nullable=False, index=True)  # SHA256 = 32 raw bytes
+    file_hash = Column(LargeBinary(32), nullable=False, unique=True)  # SHA256 = 32 raw bytes
     vote_choice = Column(String(512), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     
-    # Composite index for efficient lookup: has this voter voted in this poll?
+    # One vote per voter per poll, enforced by the database.
+    # The backing unique index also serves the "has this voter voted?" lookup.
     __table_args__ = (
-        Index('ix_votes_poll_voter', 'poll_id', 'voter_hash'),
+        UniqueConstraint('poll_id', 'voter_hash', name='uq_votes_poll_voter'),
     )
     
     def __repr__(self) -> str:
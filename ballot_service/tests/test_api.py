@@ -0,0 +1,295 @@
+"""
+API tests for the FastAPI app, using TestClient with a fake Redis.
+
+Run with: python -m pytest tests/ -v
+"""
+import hashlib
+import time
+
+import pytest
+import fakeredis
+import orjson
+from fastapi.testclient import TestClient
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import database
+import main
+from validator import BallotValidator, ValidationResult
+
+
+SIGNED_TEXT = "AFM: 123456789\nI vote for [Option A]. Security Token: {token}"
+
+
+async def _noop():
+    pass
+
+
+def _clear_caches():
+    database.get_sessionmaker.cache_clear()
+    database.get_engine.cache_clear()
+    config.get_settings.cache_clear()
+
+
+@pytest.fixture
+def redis():
+    """In-memory stand-in for the shared Redis client."""
+    return fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, redis):
+    """TestClient on a throwaway SQLite database, once deferred startup is done."""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite+aiosqlite:///{tmp_path / 'votes.db'}")
+    monkeypatch.setattr(main, "get_redis", lambda: redis)
+    monkeypatch.setattr(main, "READY", False)
+    monkeypatch.setattr(main, "INIT_ERROR", None)
+    _clear_caches()
+
+    with TestClient(main.app) as c:
+        for _ in range(50):
+            if c.get("/api/ballot/health/ready").status_code == 200:
+                break
+            time.sleep(0.05)
+        yield c
+
+    _clear_caches()
+
+
+@pytest.fixture
+def signed_pdf(monkeypatch):
+    """
+    Skip the PAdES/pypdf step: every upload counts as validly signed.
+    Set the returned dict's "text" to control the extracted declaration text.
+    """
+    state = {"text": ""}
+
+    async def fake_pdf_work(self, pdf_bytes):
+        result = ValidationResult(success=True, signer_name="Hellenic Republic")
+        return result, state["text"], hashlib.sha256(pdf_bytes).digest()
+
+    monkeypatch.setattr(BallotValidator, "_run_pdf_work", fake_pdf_work)
+    return state
+
+
+def issue_token(client, poll_id: str) -> str:
+    response = client.post("/api/ballot/token", json={"poll_id": poll_id})
+    assert response.status_code == 200
+    return response.json()["poll_token"]
+
+
+def submit(client, poll_id: str, poll_token: str, content: bytes = b"%PDF-1.4 ballot"):
+    return client.post(
+        "/api/ballot/validate",
+        files={"file": ("ballot.pdf", content, "application/pdf")},
+        data={"poll_id": poll_id, "poll_token": poll_token},
+    )
+
+
+class TestHealth:
+    """Tests for liveness and readiness probes."""
+
+    def test_live(self, client):
+        response = client.get("/api/ballot/health/live")
+        assert response.status_code == 200
+        assert response.json()["status"] == "alive"
+
+    def test_ready_after_startup(self, client):
+        response = client.get("/api/ballot/health/ready")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+
+    def test_not_ready_before_startup(self, client, monkeypatch):
+        monkeypatch.setattr(main, "READY", False)
+        response = client.get("/api/ballot/health/ready")
+        assert response.status_code == 503
+
+    def test_startup_failure_reported(self, client, monkeypatch):
+        monkeypatch.setattr(main, "INIT_ERROR", "OperationalError")
+        response = client.get("/api/ballot/health/ready")
+        assert response.status_code == 503
+        assert "OperationalError" in response.json()["detail"]
+
+    def test_live_fails_once_startup_gives_up(self, client, monkeypatch):
+        monkeypatch.setattr(main, "INIT_ERROR", "OperationalError")
+        response = client.get("/api/ballot/health/live")
+        assert response.status_code == 503
+
+
+class TestDeferredInit:
+    """Tests for the retrying startup task."""
+
+    @pytest.fixture(autouse=True)
+    def no_backoff(self, monkeypatch):
+        monkeypatch.setenv("STARTUP_RETRIES", "3")
+        monkeypatch.setenv("STARTUP_RETRY_DELAY", "0")
+        monkeypatch.setattr(main, "READY", False)
+        monkeypatch.setattr(main, "INIT_ERROR", None)
+        monkeypatch.setattr(main, "warm_pool", _noop)
+        config.get_settings.cache_clear()
+        yield
+        config.get_settings.cache_clear()
+
+    @pytest.mark.asyncio
+    async def test_transient_failure_retried(self, monkeypatch):
+        attempts = []
+
+        async def flaky_init_db():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionRefusedError("database not up yet")
+
+        monkeypatch.setattr(main, "init_db", flaky_init_db)
+        await main._deferred_init()
+
+        assert len(attempts) == 2
+        assert main.READY is True
+        assert main.INIT_ERROR is None
+
+    @pytest.mark.asyncio
+    async def test_gives_up_after_retries(self, monkeypatch):
+        attempts = []
+
+        async def failing_init_db():
+            attempts.append(1)
+            raise ConnectionRefusedError("database down")
+
+        monkeypatch.setattr(main, "init_db", failing_init_db)
+        await main._deferred_init()
+
+        assert len(attempts) == 3
+        assert main.READY is False
+        assert main.INIT_ERROR == "ConnectionRefusedError"
+
+
+class TestPollToken:
+    """Tests for the Redis-backed poll token check on /validate."""
+
+    def test_token_stored_with_ttl(self, client, redis):
+        token = issue_token(client, "poll_2024")
+
+        assert client.portal.call(redis.get, f"tok:{token}") == "poll_2024"
+        assert client.portal.call(redis.ttl, f"tok:{token}") > 0
+
+    def test_issued_token_accepted(self, client, signed_pdf):
+        token = issue_token(client, "poll_2024")
+        signed_pdf["text"] = SIGNED_TEXT.format(token=token)
+
+        response = submit(client, "poll_2024", token)
+
+        assert response.status_code == 200
+        assert response.json()["vote_choice"] == "Option A"
+
+    def test_wrong_poll_rejected(self, client, signed_pdf):
+        token = issue_token(client, "poll_2024")
+        signed_pdf["text"] = SIGNED_TEXT.format(token=token)
+
+        response = submit(client, "poll_2025", token)
+
+        assert response.status_code == 400
+        assert response.json()["detail"]["rejection_reason"] == "invalid_token"
+
+    def test_unknown_token_rejected(self, client, signed_pdf):
+        token = "00000000-0000-0000-0000-000000000000"
+        signed_pdf["text"] = SIGNED_TEXT.format(token=token)
+
+        response = submit(client, "poll_2024", token)
+
+        assert response.status_code == 400
+        assert response.json()["detail"]["rejection_reason"] == "invalid_token"
+
+    def test_missing_token_rejected(self, client):
+        response = client.post(
+            "/api/ballot/validate",
+            files={"file": ("ballot.pdf", b"%PDF-1.4 ballot", "application/pdf")},
+            data={"poll_id": "poll_2024"},
+        )
+
+        assert response.status_code == 422
+
+
+class TestUploadLimits:
+    """Tests for upload validation."""
+
+    def test_oversized_upload_rejected(self, client):
+        token = issue_token(client, "poll_2024")
+
+        response = submit(client, "poll_2024", token, content=b"x" * (main.MAX_UPLOAD_SIZE + 1))
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "File size exceeds 10MB limit"
+
+    def test_oversized_identity_upload_rejected(self, client):
+        response = client.post(
+            "/api/ballot/verify-identity",
+            files={"file": ("ballot.pdf", b"x" * (main.MAX_UPLOAD_SIZE + 1), "application/pdf")},
+        )
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "File size exceeds 10MB limit"
+
+
+class TestStatsCache:
+    """Tests for the /stats read-through cache."""
+
+    def test_cache_hit_skips_db(self, client, redis):
+        cached = {"poll_id": "poll_2024", "total_votes": 5, "choices": {"Option A": 5}}
+        client.portal.call(redis.set, "stats:poll_2024", orjson.dumps(cached))
+
+        response = client.get("/api/ballot/stats", params={"poll_id": "poll_2024"})
+
+        # The database is empty, so these counts can only come from the cache
+        assert response.json() == cached
+
+    def test_cache_miss_populates_cache(self, client, redis):
+        response = client.get("/api/ballot/stats", params={"poll_id": "poll_2024"})
+
+        assert response.json()["total_votes"] == 0
+        assert client.portal.call(redis.get, "stats:poll_2024") is not None
+
+    def test_successful_vote_invalidates_cache(self, client, redis, signed_pdf):
+        client.get("/api/ballot/stats", params={"poll_id": "poll_2024"})
+        token = issue_token(client, "poll_2024")
+        signed_pdf["text"] = SIGNED_TEXT.format(token=token)
+
+        response = submit(client, "poll_2024", token)
+
+        assert response.status_code == 200
+        assert client.portal.call(redis.get, "stats:poll_2024") is None
+        stats = client.get("/api/ballot/stats", params={"poll_id": "poll_2024"}).json()
+        assert stats["choices"] == {"Option A": 1}
+
+
+    def test_redis_down_falls_back_to_db(self, client, redis, monkeypatch):
+        async def unavailable(*args, **kwargs):
+            raise RedisConnectionError("Redis unavailable")
+
+        monkeypatch.setattr(redis, "get", unavailable)
+        monkeypatch.setattr(redis, "set", unavailable)
+
+        response = client.get("/api/ballot/stats", params={"poll_id": "poll_2024"})
+
+        assert response.status_code == 200
+        assert response.json()["total_votes"] == 0
+
+    def test_vote_recorded_when_invalidation_fails(self, client, redis, signed_pdf, monkeypatch):
+        token = issue_token(client, "poll_2024")
+        signed_pdf["text"] = SIGNED_TEXT.format(token=token)
+
+        async def unavailable(*args, **kwargs):
+            raise RedisConnectionError("Redis unavailable")
+
+        monkeypatch.setattr(redis, "delete", unavailable)
+
+        response = submit(client, "poll_2024", token)
+
+        assert response.status_code == 200
+        assert response.json()["vote_choice"] == "Option A"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
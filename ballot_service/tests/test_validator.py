@@ -4,60 +4,152 @@ Unit tests for BallotValidator.
 Run with: python -m pytest tests/ -v
 """
 import pytest
+import pytest_asyncio
 import hashlib
-from unittest.mock import Mock, patch, MagicMock
-from io import BytesIO
+import io
+from datetime import datetime, timedelta, timezone
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from validator import BallotValidator, ValidationResult, RejectionReason
-from models import Vote
-from config import settings
+from asn1crypto import keys as asn1_keys, x509 as asn1_x509
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from pyhanko.pdf_utils import generic
+from pyhanko.pdf_utils.incremental_writer import IncrementalPdfFileWriter
+from pyhanko.pdf_utils.writer import PageObject, PdfFileWriter
+from pyhanko.sign import signers
+from pyhanko_certvalidator.registry import SimpleCertificateStore
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
 
+from validator import BallotValidator, ValidationResult, RejectionReason, shutdown_pdf_executor
+from models import Base, Vote
+from config import get_settings
 
-@pytest.fixture
-def mock_db():
-    """Create a mock database session."""
-    db = Mock()
-    db.query.return_value.filter.return_value.first.return_value = None
-    return db
+
+@pytest_asyncio.fixture
+async def db():
+    """Create a session on a fresh in-memory SQLite database."""
+    # StaticPool keeps a single connection so every query sees the same in-memory DB
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    
+    SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    async with SessionLocal() as session:
+        yield session
+    
+    await engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def validator():
+    """
+    Shared BallotValidator for tests that never touch the database
+    (extraction, hashing, signer and token checks).
+    """
+    return BallotValidator(None)
 
 
 @pytest.fixture
-def validator(mock_db):
-    """Create a BallotValidator with mock database."""
-    return BallotValidator(mock_db)
+def db_validator(db):
+    """Create a BallotValidator backed by a fresh in-memory database."""
+    return BallotValidator(db)
 
 
-class TestAFMExtraction:
-    """Tests for AFM extraction from text."""
-    
-    def test_extract_afm_standard_format(self, validator):
-        text = "Name: John Doe\nAFM: 123456789\nAddress: Athens"
-        afm = validator._extract_afm(text)
-        assert afm == "123456789"
-    
-    def test_extract_afm_greek_format(self, validator):
-        text = "Ονομα: Γιάννης\nΑΦΜ: 987654321\nΔιεύθυνση: Αθήνα"
-        afm = validator._extract_afm(text)
-        assert afm == "987654321"
+async def insert_vote(db, poll_id: str, voter_hash: bytes, file_hash: bytes) -> None:
+    """Pre-insert an existing vote row."""
+    db.add(Vote(
+        poll_id=poll_id,
+        voter_hash=voter_hash,
+        file_hash=file_hash,
+        vote_choice="Option A",
+        created_at=datetime.utcnow()
+    ))
+    await db.commit()
+
+
+def make_signed_pdf(common_name: str = "Hellenic Republic", text: str = "AFM: 123456789") -> bytes:
+    """Build a one-page PDF showing `text`, PAdES-signed with a throwaway self-signed cert."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=1))
+        .add_extension(
+            x509.KeyUsage(
+                digital_signature=True, content_commitment=True, key_encipherment=False,
+                data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                crl_sign=False, encipher_only=False, decipher_only=False,
+            ),
+            critical=True,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    signer = signers.SimpleSigner(
+        signing_cert=asn1_x509.Certificate.load(cert.public_bytes(serialization.Encoding.DER)),
+        signing_key=asn1_keys.PrivateKeyInfo.load(key.private_bytes(
+            serialization.Encoding.DER,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )),
+        cert_registry=SimpleCertificateStore(),
+    )
     
-    def test_extract_afm_with_dots(self, validator):
-        text = "Α.Φ.Μ.: 111222333"
-        afm = validator._extract_afm(text)
-        assert afm == "111222333"
+    writer = PdfFileWriter()
+    font = generic.DictionaryObject({
+        generic.pdf_name('/Type'): generic.pdf_name('/Font'),
+        generic.pdf_name('/Subtype'): generic.pdf_name('/Type1'),
+        generic.pdf_name('/BaseFont'): generic.pdf_name('/Helvetica'),
+    })
+    content = generic.StreamObject(stream_data=f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode())
+    writer.insert_page(PageObject(
+        contents=writer.add_object(content),
+        media_box=generic.ArrayObject(map(generic.NumberObject, (0, 0, 595, 842))),
+        resources=generic.DictionaryObject({
+            generic.pdf_name('/Font'): generic.DictionaryObject({generic.pdf_name('/F1'): font}),
+        }),
+    ))
+    unsigned = io.BytesIO()
+    writer.write(unsigned)
+    unsigned.seek(0)
     
-    def test_extract_afm_not_found(self, validator):
-        text = "No tax ID in this document"
-        afm = validator._extract_afm(text)
-        assert afm is None
+    signed = signers.sign_pdf(
+        IncrementalPdfFileWriter(unsigned),
+        signers.PdfSignatureMetadata(field_name="Signature"),
+        signer=signer,
+    )
+    return signed.getvalue()
+
+
+@pytest.fixture(scope="module")
+def signed_pdf():
+    """A validly signed ballot, built outside the event loop (sign_pdf runs asyncio.run too)."""
+    return make_signed_pdf()
+
+
+class TestAFMExtraction:
+    """Tests for AFM extraction from text."""
     
-    def test_extract_afm_invalid_length(self, validator):
-        text = "AFM: 12345"  # Only 5 digits
-        afm = validator._extract_afm(text)
-        assert afm is None
+    @pytest.mark.parametrize("text, expected", [
+        pytest.param("Name: John Doe\nAFM: 123456789\nAddress: Athens", "123456789", id="standard_format"),
+        pytest.param("Ονομα: Γιάννης\nΑΦΜ: 987654321\nΔιεύθυνση: Αθήνα", "987654321", id="greek_format"),
+        pytest.param("Α.Φ.Μ.: 111222333", "111222333", id="with_dots"),
+        pytest.param("No tax ID in this document", None, id="not_found"),
+        pytest.param("AFM: 12345", None, id="invalid_length"),  # Only 5 digits
+    ])
+    def test_extract_afm(self, validator, text, expected):
+        assert validator._extract_afm(text) == expected
 
 
 class TestVoteChoiceExtraction:
@@ -101,8 +193,8 @@ class TestVoterHashing:
     def test_hash_voter_id_format(self, validator):
         afm = "123456789"
         hash_result = validator._hash_voter_id(afm)
-        assert len(hash_result) == 64  # SHA256 produces 64 hex characters
-        assert all(c in '0123456789abcdef' for c in hash_result)
+        assert isinstance(hash_result, bytes)
+        assert len(hash_result) == 32  # SHA256 produces a 32-byte digest
 
 
 class TestFileHashing:
@@ -118,25 +210,49 @@ class TestFileHashing:
         hash1 = validator._calculate_file_hash(b"content 1")
         hash2 = validator._calculate_file_hash(b"content 2")
         assert hash1 != hash2
+    
+    def test_file_hash_format(self, validator):
+        content = b"test pdf content"
+        hash_result = validator._calculate_file_hash(content)
+        assert isinstance(hash_result, bytes)
+        assert hash_result == hashlib.sha256(content).digest()  # 32 raw bytes, no hex
+
+
+class TestSignerMatching:
+    """Tests for allowed-signer matching."""
+    
+    @pytest.mark.parametrize("signer_name", [
+        pytest.param("HELLENIC REPUBLIC", id="upper_case"),
+        pytest.param("ministry of digital governance", id="lower_case"),
+        pytest.param("Common Name: APOSTILLE, Organization: Hellenic Republic", id="embedded_cn"),
+    ])
+    def test_allowed_signer(self, validator, signer_name):
+        assert validator._is_allowed_signer(signer_name) is True
+    
+    def test_unknown_signer(self, validator):
+        assert validator._is_allowed_signer("Common Name: Some Private CA") is False
 
 
 class TestGate2Uniqueness:
     """Tests for Gate 2: File uniqueness check."""
     
-    def test_unique_file_passes(self, mock_db):
-        mock_db.query.return_value.filter.return_value.first.return_value = None
-        validator = BallotValidator(mock_db)
+    @pytest.mark.asyncio
+    async def test_unique_file_passes(self, db_validator):
+        file_hash = hashlib.sha256(b"abc").digest()
         
-        result = validator._gate2_check_uniqueness("abc123hash")
+        duplicate_file, _ = await db_validator._check_existing_votes(file_hash, "poll_2024", None)
+        result = db_validator._gate2_check_uniqueness(file_hash, duplicate_file)
         
         assert result.success is True
     
-    def test_duplicate_file_fails(self, mock_db):
-        # Simulate existing vote with same file hash
-        mock_db.query.return_value.filter.return_value.first.return_value = Mock()
-        validator = BallotValidator(mock_db)
+    @pytest.mark.asyncio
+    async def test_duplicate_file_fails(self, db, db_validator):
+        # Existing vote with same file hash
+        file_hash = hashlib.sha256(b"abc").digest()
+        await insert_vote(db, "poll_2024", db_validator._hash_voter_id("123456789"), file_hash)
         
-        result = validator._gate2_check_uniqueness("abc123hash")
+        duplicate_file, _ = await db_validator._check_existing_votes(file_hash, "poll_2024", None)
+        result = db_validator._gate2_check_uniqueness(file_hash, duplicate_file)
         
         assert result.success is False
         assert result.rejection_reason == RejectionReason.DUPLICATE_FILE
@@ -156,46 +272,160 @@ class TestGate3Token:
         assert result.success is False
         assert result.rejection_reason == RejectionReason.TOKEN_NOT_FOUND
     
+    @pytest.mark.parametrize("text", [
+        pytest.param("Declaration content with Security\nToken: abc-123-xyz", id="label_wrapped"),
+        pytest.param("Declaration content with Security Token : abc-123-xyz", id="space_before_colon"),
+        pytest.param("Declaration content with Security Token:\nabc-123-xyz", id="token_wrapped"),
+    ])
+    def test_token_found_with_pdf_line_breaks(self, validator, text):
+        result = validator._gate3_verify_token(text, "abc-123-xyz")
+        assert result.success is True
+    
+    def test_different_token_fails(self, validator):
+        text = "Declaration content with Security Token: abc-123-xyz"
+        result = validator._gate3_verify_token(text, "abc-123-xy")
+        assert result.success is False
+        assert result.rejection_reason == RejectionReason.TOKEN_NOT_FOUND
+    
     def test_empty_token_fails(self, validator):
         text = "Some declaration text"
         result = validator._gate3_verify_token(text, "")
         assert result.success is False
         assert result.rejection_reason == RejectionReason.INVALID_TOKEN
+    
+    @pytest.mark.asyncio
+    async def test_wrong_token_rejected_before_db_lookup(self, monkeypatch):
+        # No session: any database query would raise
+        no_db_validator = BallotValidator(None)
+        text = "AFM: 123456789 Security Token: abc-123-xyz"
+        
+        async def fake_pdf_work(pdf_bytes):
+            return ValidationResult(success=True), text, hashlib.sha256(pdf_bytes).digest()
+        
+        monkeypatch.setattr(no_db_validator, "_run_pdf_work", fake_pdf_work)
+        result = await no_db_validator.validate(b"%PDF-1.4", "poll_2024", "other-token")
+        
+        assert result.success is False
+        assert result.rejection_reason == RejectionReason.TOKEN_NOT_FOUND
 
 
 class TestGate4Identity:
     """Tests for Gate 4: Voter identity verification."""
     
-    def test_new_voter_passes(self, mock_db):
-        mock_db.query.return_value.filter.return_value.first.return_value = None
-        validator = BallotValidator(mock_db)
+    @pytest.mark.asyncio
+    async def test_new_voter_passes(self, db_validator):
+        voter_hash = db_validator._hash_voter_id("123456789")
         
-        text = "AFM: 123456789"
-        result = validator._gate4_verify_identity(text, "poll_2024")
+        _, already_voted = await db_validator._check_existing_votes(b"file", "poll_2024", voter_hash)
+        result = await db_validator._gate4_verify_identity(voter_hash, "poll_2024", already_voted)
         
         assert result.success is True
         assert result.voter_hash is not None
     
-    def test_afm_not_found_fails(self, mock_db):
-        validator = BallotValidator(mock_db)
-        
-        text = "No tax ID here"
-        result = validator._gate4_verify_identity(text, "poll_2024")
+    @pytest.mark.asyncio
+    async def test_afm_not_found_fails(self, validator):
+        result = await validator._gate4_verify_identity(None, "poll_2024", False)
         
         assert result.success is False
         assert result.rejection_reason == RejectionReason.AFM_NOT_FOUND
     
-    def test_already_voted_fails(self, mock_db):
-        # Simulate existing vote from same voter
-        mock_db.query.return_value.filter.return_value.first.return_value = Mock()
-        validator = BallotValidator(mock_db)
-        validator.allow_vote_update = False
+    @pytest.mark.asyncio
+    async def test_already_voted_fails(self, db, db_validator):
+        # Existing vote from same voter
+        db_validator.allow_vote_update = False
+        voter_hash = db_validator._hash_voter_id("123456789")
+        await insert_vote(db, "poll_2024", voter_hash, hashlib.sha256(b"earlier").digest())
         
-        text = "AFM: 123456789"
-        result = validator._gate4_verify_identity(text, "poll_2024")
+        _, already_voted = await db_validator._check_existing_votes(b"file", "poll_2024", voter_hash)
+        result = await db_validator._gate4_verify_identity(voter_hash, "poll_2024", already_voted)
         
         assert result.success is False
         assert result.rejection_reason == RejectionReason.ALREADY_VOTED
+    
+    @pytest.mark.asyncio
+    async def test_same_voter_other_poll_passes(self, db, db_validator):
+        voter_hash = db_validator._hash_voter_id("123456789")
+        await insert_vote(db, "poll_2023", voter_hash, hashlib.sha256(b"earlier").digest())
+        
+        _, already_voted = await db_validator._check_existing_votes(b"file", "poll_2024", voter_hash)
+        result = await db_validator._gate4_verify_identity(voter_hash, "poll_2024", already_voted)
+        
+        assert result.success is True
+
+
+class TestRecordVote:
+    """Tests for the atomic vote insert."""
+    
+    @pytest.mark.asyncio
+    async def test_new_vote_recorded(self, db_validator):
+        voter_hash = db_validator._hash_voter_id("123456789")
+        
+        rejection = await db_validator._record_vote(
+            "poll_2024", voter_hash, hashlib.sha256(b"one").digest(), "Option A"
+        )
+        
+        assert rejection is None
+    
+    @pytest.mark.asyncio
+    async def test_second_vote_same_voter_rejected(self, db_validator):
+        voter_hash = db_validator._hash_voter_id("123456789")
+        await db_validator._record_vote(
+            "poll_2024", voter_hash, hashlib.sha256(b"one").digest(), "Option A"
+        )
+        
+        rejection = await db_validator._record_vote(
+            "poll_2024", voter_hash, hashlib.sha256(b"two").digest(), "Option B"
+        )
+        
+        assert rejection == RejectionReason.ALREADY_VOTED
+    
+    @pytest.mark.asyncio
+    async def test_same_file_rejected(self, db_validator):
+        file_hash = hashlib.sha256(b"one").digest()
+        await db_validator._record_vote(
+            "poll_2024", db_validator._hash_voter_id("123456789"), file_hash, "Option A"
+        )
+        
+        rejection = await db_validator._record_vote(
+            "poll_2024", db_validator._hash_voter_id("987654321"), file_hash, "Option A"
+        )
+        
+        assert rejection == RejectionReason.DUPLICATE_FILE
+
+
+class TestPdfParsing:
+    """Tests for the off-loop PDF parsing step."""
+    
+    @pytest.mark.asyncio
+    async def test_malformed_pdf_rejected(self, validator):
+        result, text, file_hash = await validator._run_pdf_work(b"%PDF-1.4 not really a pdf")
+        
+        assert text is None
+        assert file_hash is None
+        assert result.success is False
+        assert result.rejection_reason == RejectionReason.INVALID_SIGNATURE
+    
+    @pytest.mark.asyncio
+    async def test_signed_pdf_verified_inside_running_loop(self, validator, signed_pdf):
+        # pyhanko's sync validate_pdf_signature calls asyncio.run(), which
+        # fails if gate 1 ever runs on the event loop again
+        result, text, file_hash = await validator._run_pdf_work(signed_pdf)
+        
+        assert result.success is True, result.message
+        assert "Hellenic Republic" in result.signer_name
+        assert "AFM: 123456789" in text
+        assert file_hash == hashlib.sha256(signed_pdf).digest()
+    
+    @pytest.mark.asyncio
+    async def test_pool_restarts_after_shutdown(self, validator):
+        # lifespan shuts the pool down; a later app start must get a fresh one
+        await validator._run_pdf_work(b"%PDF-1.4")
+        shutdown_pdf_executor()
+        
+        result, text, _ = await validator._run_pdf_work(b"%PDF-1.4")
+        
+        assert text is None
+        assert result.rejection_reason == RejectionReason.INVALID_SIGNATURE
 
 
 if __name__ == "__main__":
@@ -7,10 +7,14 @@ Implements 4 security gates:
 3. Context (Session Security): Verify poll token in text
 4. Identity (One Person, One Vote): Hash AFM and check voter uniqueness
 """
+import asyncio
 import hashlib
+import hmac
 import re
 import io
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
 from typing import Optional, Tuple, List
 from datetime import datetime
@@ -21,12 +25,32 @@ from pyhanko.sign.validation import validate_pdf_signature
 from pyhanko.sign.validation.settings import KeyUsageConstraints
 from pyhanko.pdf_utils.reader import PdfFileReader
 from pyhanko.sign.validation.errors import SignatureValidationError
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, exists, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from config import settings
+from config import get_settings
 from models import Vote
 
 
+@lru_cache
+def _get_pdf_executor() -> ThreadPoolExecutor:
+    """Bounded pool for blocking PDF parsing and signature checks."""
+    return ThreadPoolExecutor(
+        max_workers=get_settings().PDF_WORKERS,
+        thread_name_prefix="pdf",
+    )
+
+
+def shutdown_pdf_executor() -> None:
+    """Stop the PDF pool if it was ever started; the next use starts a fresh one."""
+    if _get_pdf_executor.cache_info().currsize:
+        _get_pdf_executor().shutdown(wait=False, cancel_futures=True)
+        _get_pdf_executor.cache_clear()
+
+
 class RejectionReason(str, Enum):
     """Enumeration of all possible rejection reasons."""
     INVALID_SIGNATURE = "invalid_signature"
@@ -47,9 +71,9 @@ class ValidationResult:
     success: bool
     rejection_reason: Optional[RejectionReason] = None
     message: str = ""
-    voter_hash: Optional[str] = None
+    voter_hash: Optional[bytes] = None
     vote_choice: Optional[str] = None
-    file_hash: Optional[str] = None
+    file_hash: Optional[bytes] = None
     signer_name: Optional[str] = None
 
 
@@ -59,27 +83,35 @@ class BallotValidator:
     
     Usage:
         validator = BallotValidator(db_session)
-        result = validator.validate(pdf_bytes, poll_id, poll_token)
+        result = await validator.validate(pdf_bytes, poll_id, poll_token)
     """
     
     # Regex patterns for text extraction
+    # Compiled once at class definition; the extract helpers never call re.compile/re.search
     AFM_PATTERN = re.compile(r"(?:AFM|ΑΦΜ|Α\.Φ\.Μ\.|Tax ID)[:\s]*(\d{9})", re.IGNORECASE)
     VOTE_CHOICE_PATTERN = re.compile(r"vote for \[(.*?)\]", re.IGNORECASE)
     # Alternative Greek patterns - more flexible
     VOTE_CHOICE_PATTERN_GR = re.compile(r"ψηφίζω \[(.*?)\]", re.IGNORECASE)
     VOTE_CHOICE_PATTERN_GR_ALT = re.compile(r"ψηφίζω[\s:]+([^.\n]+)", re.IGNORECASE)  # More flexible Greek
     VOTE_CHOICE_PATTERN_GR_OTI = re.compile(r"ψηφίζω (?:για |υπέρ )?(.+?)(?:\.|$)", re.IGNORECASE)  # Even more flexible
+    # Token as written by the /instructions template: "Security Token: <uuid>"
+    # \s+ / \s* tolerate pypdf wrapping the label across lines or spacing the colon
+    SECURITY_TOKEN_PATTERN = re.compile(r"Security\s+Token\s*:\s*([0-9A-Za-z-]+)", re.IGNORECASE)
     
-    def __init__(self, db: Session):
-        """Initialize validator with database session."""
+    def __init__(self, db: AsyncSession):
+        """Initialize validator with an async database session."""
         self.db = db
-        self.allowed_signers = settings.ALLOWED_SIGNERS
+        settings = get_settings()
+        self.debug = settings.DEBUG
+        self.allowed_signers = settings.allowed_signers_set
         self.salt_key = settings.SALT_KEY
         self.allow_vote_update = settings.ALLOW_VOTE_UPDATE
     
     async def validate(self, pdf_bytes: bytes, poll_id: str, poll_token: str) -> ValidationResult:
         """
-        Main validation method. Runs all 4 gates sequentially.
+        Main validation method. Runs all 4 gates.
+        Gate 3 is pure CPU and runs first, so a wrong token never reaches the
+        database; the gate 2 and gate 4 lookups are then combined into one query.
         
         Args:
             pdf_bytes: Raw bytes of the uploaded PDF file
@@ -89,34 +121,30 @@ class BallotValidator:
         Returns:
             ValidationResult with success status and details
         """
-        # Gate 1: Integrity (Anti-Forgery)
-        gate1_result = await self._gate1_verify_signature(pdf_bytes)
-        if not gate1_result.success:
+        # Gate 1, text extraction and file hashing run on the PDF worker pool
+        gate1_result, text, file_hash = await self._run_pdf_work(pdf_bytes)
+        if text is None:
             return gate1_result
         
-        # Gate 2: Uniqueness (Anti-Spam)
-        file_hash = self._calculate_file_hash(pdf_bytes)
-        gate2_result = self._gate2_check_uniqueness(file_hash)
-        if not gate2_result.success:
-            return gate2_result
-        
-        # Extract text for remaining gates
-        try:
-            text = self._extract_text(pdf_bytes)
-        except Exception as e:
-            return ValidationResult(
-                success=False,
-                rejection_reason=RejectionReason.PDF_READ_ERROR,
-                message=f"Failed to extract text from PDF: {str(e)}"
-            )
-        
         # Gate 3: Context (Session Security)
         gate3_result = self._gate3_verify_token(text, poll_token)
         if not gate3_result.success:
             return gate3_result
         
+        # Gates 2 and 4 share a single database round-trip
+        afm = self._extract_afm(text)
+        voter_hash = self._hash_voter_id(afm) if afm else None
+        duplicate_file, already_voted = await self._check_existing_votes(
+            file_hash, poll_id, voter_hash
+        )
+        
+        # Gate 2: Uniqueness (Anti-Spam)
+        gate2_result = self._gate2_check_uniqueness(file_hash, duplicate_file)
+        if not gate2_result.success:
+            return gate2_result
+        
         # Gate 4: Identity (One Person, One Vote)
-        gate4_result = self._gate4_verify_identity(text, poll_id)
+        gate4_result = await self._gate4_verify_identity(voter_hash, poll_id, already_voted)
         if not gate4_result.success:
             return gate4_result
         
@@ -130,13 +158,23 @@ class BallotValidator:
             )
         
         # All gates passed - record the vote
-        voter_hash = gate4_result.voter_hash
-        self._record_vote(
+        # The insert is the authoritative uniqueness check; concurrent submissions
+        # that both passed the pre-check are caught here
+        rejection = await self._record_vote(
             poll_id=poll_id,
             voter_hash=voter_hash,
             file_hash=file_hash,
             vote_choice=vote_choice
         )
+        if rejection == RejectionReason.DUPLICATE_FILE:
+            return self._gate2_check_uniqueness(file_hash, duplicate_file=True)
+        if rejection == RejectionReason.ALREADY_VOTED:
+            return ValidationResult(
+                success=False,
+                rejection_reason=RejectionReason.ALREADY_VOTED,
+                message="You have already voted in this poll",
+                voter_hash=voter_hash
+            )
         
         return ValidationResult(
             success=True,
@@ -160,21 +198,11 @@ class BallotValidator:
         - Vote choice (not voting)
         - Uniqueness (allows checking identity multiple times if needed, though usually done once)
         """
-        # Gate 1: Integrity (Anti-Forgery)
-        gate1_result = await self._gate1_verify_signature(pdf_bytes)
-        if not gate1_result.success:
+        # Gate 1 + text extraction run on the PDF worker pool
+        gate1_result, text, _ = await self._run_pdf_work(pdf_bytes)
+        if text is None:
             return gate1_result
             
-        # Extract text
-        try:
-            text = self._extract_text(pdf_bytes)
-        except Exception as e:
-            return ValidationResult(
-                success=False,
-                rejection_reason=RejectionReason.PDF_READ_ERROR,
-                message=f"Failed to extract text from PDF: {str(e)}"
-            )
-            
         # Extract AFM and hash it
         afm = self._extract_afm(text)
         if not afm:
@@ -193,7 +221,44 @@ class BallotValidator:
             signer_name=gate1_result.signer_name
         )
     
-    async def _gate1_verify_signature(self, pdf_bytes: bytes) -> ValidationResult:
+    async def _run_pdf_work(
+        self, pdf_bytes: bytes
+    ) -> Tuple[ValidationResult, Optional[str], Optional[bytes]]:
+        """Run _parse_and_verify_pdf off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _get_pdf_executor(), self._parse_and_verify_pdf, pdf_bytes
+        )
+    
+    def _parse_and_verify_pdf(
+        self, pdf_bytes: bytes
+    ) -> Tuple[ValidationResult, Optional[str], Optional[bytes]]:
+        """
+        Blocking PDF work: Gate 1 signature check, text extraction and the
+        file digest used by Gate 2.
+        
+        Returns:
+            (result, text, file_hash). text and file_hash are None when the
+            PDF was rejected, in which case result holds the rejection.
+        """
+        # Gate 1: Integrity (Anti-Forgery)
+        gate1_result = self._gate1_verify_signature(pdf_bytes)
+        if not gate1_result.success:
+            return gate1_result, None, None
+        
+        # Extract text for remaining gates
+        try:
+            text = self._extract_text(pdf_bytes)
+        except Exception as e:
+            return ValidationResult(
+                success=False,
+                rejection_reason=RejectionReason.PDF_READ_ERROR,
+                message=f"Failed to extract text from PDF: {str(e)}"
+            ), None, None
+        
+        return gate1_result, text, self._calculate_file_hash(pdf_bytes)
+    
+    def _gate1_verify_signature(self, pdf_bytes: bytes) -> ValidationResult:
         """
         Gate 1: Verify the PDF has a valid PAdES digital signature from government.
         
@@ -301,21 +366,47 @@ class BallotValidator:
     
     def _is_allowed_signer(self, signer_name: str) -> bool:
         """Check if the signer name matches any allowed government authority."""
-        signer_upper = signer_name.upper()
-        for allowed in self.allowed_signers:
-            if allowed.upper() in signer_upper or signer_upper in allowed.upper():
-                return True
-        return False
+        signer = signer_name.casefold()
+        if signer in self.allowed_signers:
+            return True
+        # Subject strings usually embed the CN among other attributes
+        # ("Common Name: ..., Organization: ..."), so fall back to substring matching
+        return any(
+            allowed in signer or signer in allowed
+            for allowed in self.allowed_signers
+        )
+    
+    async def _check_existing_votes(
+        self, file_hash: bytes, poll_id: str, voter_hash: Optional[bytes]
+    ) -> Tuple[bool, bool]:
+        """
+        Look up both duplicate conditions in one query.
+        
+        Returns:
+            (duplicate_file, already_voted). already_voted is False when
+            no voter_hash is available (AFM not found).
+        """
+        columns = [exists().where(Vote.file_hash == file_hash).label("dup_file")]
+        if voter_hash is not None:
+            columns.append(
+                exists().where(
+                    Vote.poll_id == poll_id,
+                    Vote.voter_hash == voter_hash
+                ).label("dup_voter")
+            )
+        
+        row = (await self.db.execute(select(*columns))).one()
+        duplicate_file = bool(row.dup_file)
+        already_voted = bool(row.dup_voter) if voter_hash is not None else False
+        return duplicate_file, already_voted
     
-    def _gate2_check_uniqueness(self, file_hash: str) -> ValidationResult:
+    def _gate2_check_uniqueness(self, file_hash: bytes, duplicate_file: bool) -> ValidationResult:
         """
         Gate 2: Check if this exact file has been uploaded before.
         
         Prevents the same declaration from being used twice.
         """
-        existing = self.db.query(Vote).filter(Vote.file_hash == file_hash).first()
-        
-        if existing:
+        if duplicate_file:
             return ValidationResult(
                 success=False,
                 rejection_reason=RejectionReason.DUPLICATE_FILE,
@@ -331,7 +422,7 @@ class BallotValidator:
     
     def _gate3_verify_token(self, text: str, poll_token: str) -> ValidationResult:
         """
-        Gate 3: Verify the poll token appears in the declaration text.
+        Gate 3: Verify the declaration's "Security Token:" matches the poll token.
         
         Ensures the declaration was created specifically for this voting session.
         NOTE: For testing/demo, this gate is relaxed. In production, require the token.
@@ -345,13 +436,19 @@ class BallotValidator:
         
         # For now, skip strict token validation if DEBUG is enabled
         # This allows testing with real Gov.gr documents that don't have our token
-        if settings.DEBUG:
+        if self.debug:
             return ValidationResult(
                 success=True,
                 message="Token check bypassed in debug mode"
             )
         
-        if poll_token not in text:
+        # Compare every labelled token in constant time to avoid a timing side-channel
+        expected = poll_token.encode('utf-8')
+        token_found = False
+        for match in self.SECURITY_TOKEN_PATTERN.finditer(text):
+            token_found |= hmac.compare_digest(match.group(1).encode('utf-8'), expected)
+        
+        if not token_found:
             return ValidationResult(
                 success=False,
                 rejection_reason=RejectionReason.TOKEN_NOT_FOUND,
@@ -363,35 +460,31 @@ class BallotValidator:
             message="Token verified"
         )
     
-    def _gate4_verify_identity(self, text: str, poll_id: str) -> ValidationResult:
+    async def _gate4_verify_identity(
+        self, voter_hash: Optional[bytes], poll_id: str, already_voted: bool
+    ) -> ValidationResult:
         """
-        Gate 4: Extract AFM, hash it, and check if voter has already voted.
+        Gate 4: Check the hashed AFM hasn't already voted in this poll.
         
         Privacy is maintained by never storing the raw AFM.
         """
-        # Extract AFM from text
-        afm = self._extract_afm(text)
-        if not afm:
+        if voter_hash is None:
             return ValidationResult(
                 success=False,
                 rejection_reason=RejectionReason.AFM_NOT_FOUND,
                 message="Could not find AFM/Tax ID in the declaration"
             )
         
-        # Hash AFM with salt for privacy
-        voter_hash = self._hash_voter_id(afm)
-        
-        # Check if this voter has already voted in this poll
-        existing_vote = self.db.query(Vote).filter(
-            Vote.poll_id == poll_id,
-            Vote.voter_hash == voter_hash
-        ).first()
-        
-        if existing_vote:
+        if already_voted:
             if self.allow_vote_update:
                 # Delete existing vote to allow update
-                self.db.delete(existing_vote)
-                self.db.commit()
+                await self.db.execute(
+                    delete(Vote).where(
+                        Vote.poll_id == poll_id,
+                        Vote.voter_hash == voter_hash
+                    )
+                )
+                await self.db.commit()
                 return ValidationResult(
                     success=True,
                     message="Previous vote will be updated",
@@ -411,14 +504,15 @@ class BallotValidator:
             voter_hash=voter_hash
         )
     
-    def _calculate_file_hash(self, pdf_bytes: bytes) -> str:
-        """Calculate SHA-256 hash of the entire file."""
-        return hashlib.sha256(pdf_bytes).hexdigest()
+    def _calculate_file_hash(self, pdf_bytes: bytes) -> bytes:
+        """Calculate SHA-256 digest (32 raw bytes) of the entire file."""
+        # One call over the whole buffer lets OpenSSL use SHA-NI / ARMv8 SHA2 end-to-end
+        return hashlib.sha256(pdf_bytes).digest()
     
-    def _hash_voter_id(self, afm: str) -> str:
+    def _hash_voter_id(self, afm: str) -> bytes:
         """Hash AFM with salt for privacy-preserving voter identification."""
         combined = f"{afm}{self.salt_key}"
-        return hashlib.sha256(combined.encode('utf-8')).hexdigest()
+        return hashlib.sha256(combined.encode('utf-8')).digest()
     
     def _extract_text(self, pdf_bytes: bytes) -> str:
         """Extract all text content from PDF."""
@@ -436,9 +530,7 @@ class BallotValidator:
     def _extract_afm(self, text: str) -> Optional[str]:
         """Extract AFM (Tax ID) from text using regex."""
         match = self.AFM_PATTERN.search(text)
-        if match:
-            return match.group(1)
-        return None
+        return match.group(1) if match else None
     
     def _extract_vote_choice(self, text: str) -> Optional[str]:
         """Extract vote choice from text using multiple regex patterns."""
@@ -469,16 +561,37 @@ class BallotValidator:
         
         return None
     
-    def _record_vote(self, poll_id: str, voter_hash: str, file_hash: str, vote_choice: str) -> Vote:
-        """Record the validated vote in the database."""
-        vote = Vote(
+    async def _record_vote(
+        self, poll_id: str, voter_hash: bytes, file_hash: bytes, vote_choice: str
+    ) -> Optional[RejectionReason]:
+        """
+        Record the validated vote in the database.
+        
+        Uses INSERT ... ON CONFLICT (poll_id, voter_hash) DO NOTHING so the
+        unique constraint decides double votes atomically.
+        
+        Returns:
+            None if the vote was stored, otherwise ALREADY_VOTED or DUPLICATE_FILE.
+        """
+        insert = pg_insert if self.db.bind.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert(Vote).values(
             poll_id=poll_id,
             voter_hash=voter_hash,
             file_hash=file_hash,
             vote_choice=vote_choice,
             created_at=datetime.utcnow()
-        )
-        self.db.add(vote)
-        self.db.commit()
-        self.db.refresh(vote)
-        return vote
+        ).on_conflict_do_nothing(
+            index_elements=[Vote.poll_id, Vote.voter_hash]
+        ).returning(Vote.id)
+        
+        try:
+            vote_id = (await self.db.execute(stmt)).scalar_one_or_none()
+            await self.db.commit()
+        except IntegrityError:
+            # Only the file_hash unique constraint can still raise
+            await self.db.rollback()
+            return RejectionReason.DUPLICATE_FILE
+        
+        if vote_id is None:
+            return RejectionReason.ALREADY_VOTED
+        return None